@@ -32,15 +32,126 @@ Strict mode (raises BudgetExceeded instead of silently waiting):
     except BudgetExceeded:
         # handle oversized request
         ...
+
+Reconciling estimates with actual usage (refunds over-estimates to the budget):
+    with throttle.reserve(throttle.estimate(prompt)) as r:
+        response = call_your_api(prompt)
+        r.record(actual_prompt_tokens, actual_completion_tokens)
+    # If the block raises first, the estimate stays charged; call
+    # throttle.refund(r) if the request never went out.
 """
 
+import os
+import threading
 import time
-import re
-from typing import Iterator, Optional
+from typing import Iterable, Iterator, Optional
+
+
+# Sentence terminators followed by whitespace. The lookahead leaves the
+# whitespace unconsumed so matches report the terminator itself. Compiled on
+# first use by _rfind_sentence so importing this module doesn't load `re`.
+_SENTENCE_PATTERN = r"[.!?](?=\s)"
+_SENTENCE_RE = None
+
+# Window size for the right-to-left sentence scan in _rfind_sentence.
+_SCAN_WINDOW = 512
+
+# Bucket credit is kept in integer units of 1/_NS_PER_MINUTE token, so refilling
+# at `budget` tokens per minute adds exactly `budget` units per elapsed nanosecond.
+_NS_PER_MINUTE = 60_000_000_000
+
+
+def _rfind_sentence(text: str, start: int, end: int) -> int:
+    """
+    Return the offset just past the last sentence terminator and the whitespace
+    run that follows it in text[start:end], or -1 if there is none.
+
+    re has no reverse search, so scan fixed-size windows from the right and stop
+    at the first window with a match. Prose usually resolves in the first window;
+    text without terminators costs a single regex pass over the range.
+    """
+    global _SENTENCE_RE
+    if _SENTENCE_RE is None:
+        import re
+        _SENTENCE_RE = re.compile(_SENTENCE_PATTERN)
+
+    hi = end
+    while hi > start:
+        lo = max(start, hi - _SCAN_WINDOW)
+        last = None
+        # Extend one char past hi so the lookahead can see the whitespace
+        for last in _SENTENCE_RE.finditer(text, lo, min(hi + 1, end)):
+            pass
+        if last is not None:
+            # Extend over the whole whitespace run, as [.!?]\s+ would
+            run_end = last.end() + 1
+            while run_end < end and text[run_end].isspace():
+                run_end += 1
+            return run_end
+        hi = lo
+    return -1
+
+
+def _find_break(text: str, pos: int, max_chars: int) -> tuple[int, int]:
+    """
+    Locate the next chunk boundary within text[pos:pos + max_chars].
+
+    Returns (chunk_end, next_pos): the chunk is text[pos:chunk_end] and the
+    following chunk starts at next_pos. Whitespace around the break is excluded
+    from both by moving the offsets, so no stripped copies are made.
+    """
+    end = pos + max_chars
+    floor = pos + max_chars // 4
+
+    # Try to break at paragraph boundary
+    break_pos = text.rfind("\n\n", floor, end)
+
+    # Fall back to sentence boundary; the whitespace run after it must end past floor
+    if break_pos < floor:
+        sentence_end = _rfind_sentence(text, pos, end)
+        break_pos = sentence_end if sentence_end > floor else -1
+
+    # Fall back to word boundary
+    if break_pos < floor:
+        break_pos = text.rfind(" ", floor, end)
+
+    # Last resort: hard cut
+    if break_pos < floor:
+        break_pos = end
+
+    # Trim trailing whitespace of this chunk
+    chunk_end = break_pos
+    while chunk_end > pos and text[chunk_end - 1].isspace():
+        chunk_end -= 1
+
+    # Skip leading whitespace of the next chunk
+    next_pos = break_pos
+    length = len(text)
+    while next_pos < length and text[next_pos].isspace():
+        next_pos += 1
+
+    return chunk_end, next_pos
 
 
 class TokenThrottle:
-    """Track token usage within a rolling minute window and throttle to stay under budget."""
+    """Meter token usage with a token bucket that refills at `budget` tokens per minute."""
+
+    __slots__ = (
+        "tpm",
+        "margin",
+        "strict",
+        "budget",
+        "chunk_size",
+        "chars_per_token",
+        "_strict_limit",
+        "_max_chars",
+        "_inv_chars_per_token",
+        "_cpt_shift",
+        "_capacity",
+        "_credit",
+        "_last_refill_ns",
+        "_lock",
+    )
 
     def __init__(
         self,
@@ -61,36 +172,69 @@ class TokenThrottle:
             chars_per_token: Characters-per-token ratio for estimation (4 ≈ English).
             strict: If True, raise BudgetExceeded instead of waiting when a single
                     request exceeds the budget. Useful for catching oversized calls early.
+
+        Raises:
+            ValueError: If the effective budget works out to less than 1 token per minute.
         """
         self.tpm = tokens_per_minute
         self.margin = margin
         self.strict = strict
         _effective = int(tokens_per_minute * margin)
         self.budget = min(budget, _effective) if budget is not None else _effective
+        if self.budget < 1:
+            raise ValueError(
+                f"Effective budget must be at least 1 token per minute, got {self.budget} "
+                f"(tokens_per_minute={tokens_per_minute}, margin={margin}, budget={budget})."
+            )
         self.chunk_size = chunk_size or self.budget
         self.chars_per_token = chars_per_token
 
-        self._tokens_used = 0
-        self._window_start = time.monotonic()
+        # strict is fixed at construction, so fold it into a single limit:
+        # wait_if_needed does one comparison instead of testing the flag each call
+        self._strict_limit = self.budget if strict else float("inf")
+
+        # Derived once here so estimate() and consume() skip per-call arithmetic
+        self._max_chars = int(self.chunk_size * chars_per_token)
+        self._inv_chars_per_token = 1.0 / chars_per_token
+
+        # Integer power-of-two ratios (e.g. the default 4.0) estimate with a shift
+        cpt = int(chars_per_token)
+        is_pow2 = cpt == chars_per_token and cpt > 0 and cpt & (cpt - 1) == 0
+        self._cpt_shift = cpt.bit_length() - 1 if is_pow2 else None
+
+        # Token bucket: starts full and refills continuously at `budget` tokens/minute.
+        # Integer nanosecond math keeps the hot path free of float rounding.
+        self._capacity = self.budget * _NS_PER_MINUTE
+        self._credit = self._capacity
+        self._last_refill_ns = time.monotonic_ns()
+
+        # Guards the bucket state; sleeping always happens outside it
+        self._lock = threading.Lock()
 
     # ── Estimation ──────────────────────────────────────────────
 
     def estimate(self, text: str) -> int:
         """Estimate token count from text length."""
-        return max(1, int(len(text) / self.chars_per_token))
-
-    # ── Window management ───────────────────────────────────────
-
-    def _maybe_reset_window(self) -> None:
-        elapsed = time.monotonic() - self._window_start
-        if elapsed >= 60.0:
-            self._tokens_used = 0
-            self._window_start = time.monotonic()
+        if self._cpt_shift is not None:
+            return max(1, len(text) >> self._cpt_shift)
+        return max(1, int(len(text) * self._inv_chars_per_token))
+
+    # ── Bucket management ───────────────────────────────────────
+
+    def _refill(self) -> None:
+        # Caller must hold self._lock
+        now_ns = time.monotonic_ns()
+        self._credit = min(
+            self._capacity,
+            self._credit + (now_ns - self._last_refill_ns) * self.budget,
+        )
+        self._last_refill_ns = now_ns
 
     def reset(self) -> None:
-        """Manually reset the usage window."""
-        self._tokens_used = 0
-        self._window_start = time.monotonic()
+        """Manually refill the bucket to the full budget."""
+        with self._lock:
+            self._credit = self._capacity
+            self._last_refill_ns = time.monotonic_ns()
 
     # ── Throttling ──────────────────────────────────────────────
 
@@ -98,72 +242,93 @@ class TokenThrottle:
         """
         Reserve `tokens` from the budget, sleeping if necessary.
 
-        Returns seconds slept (0 if no wait was needed).
+        Returns seconds slept (0 if no wait was needed). Safe to call from
+        multiple threads: concurrent callers queue up behind each other's deficit.
 
         Raises:
-            BudgetExceeded: If strict=True and `tokens` exceeds the per-window budget.
+            BudgetExceeded: If strict=True and `tokens` exceeds the per-minute budget.
         """
-        if self.strict and tokens > self.budget:
+        if tokens > self._strict_limit:
             raise BudgetExceeded(
                 f"Request of {tokens} tokens exceeds budget of {self.budget} TPM. "
                 "Reduce the request size or lower strict=True."
             )
 
-        self._maybe_reset_window()
+        with self._lock:
+            self._refill()
 
-        if self._tokens_used + tokens <= self.budget:
-            self._tokens_used += tokens
-            return 0.0
+            # Deduct up front; a negative balance is the deficit still to refill
+            self._credit = credit = self._credit - tokens * _NS_PER_MINUTE
 
-        # Need to wait for window reset
-        elapsed = time.monotonic() - self._window_start
-        sleep_time = max(0.0, 60.0 - elapsed + 0.5)  # +0.5s buffer
-        if sleep_time > 0:
-            time.sleep(sleep_time)
+        if credit >= 0:
+            return 0.0
 
-        # Reset after sleeping
-        self._tokens_used = tokens
-        self._window_start = time.monotonic()
+        # Sleep exactly as long as the refill needs to cover the deficit (rounded up)
+        sleep_time = -(credit // self.budget) / 1e9
+        time.sleep(sleep_time)
         return sleep_time
 
-    # ── Chunking ────────────────────────────────────────────────
+    # ── Reservations ────────────────────────────────────────────
 
-    def _split_text(self, text: str, max_chars: int) -> list[str]:
-        """Split text into chunks of roughly max_chars, breaking on paragraph/sentence/word boundaries."""
-        if len(text) <= max_chars:
-            return [text]
+    def reserve(self, tokens: int, refund_on_error: bool = False) -> "Reservation":
+        """
+        Reserve `tokens` like wait_if_needed and return a handle for reconciling usage.
 
-        chunks = []
-        remaining = text
+        Pass the handle to commit() (or call its record()) once the API reports the
+        actual token count, so an over-estimate is returned to the bucket right away.
 
-        while remaining:
-            if len(remaining) <= max_chars:
-                chunks.append(remaining)
-                break
+        By default an unrecorded reservation stays charged even if its with-block
+        raises, since the provider may already have counted the request. Set
+        refund_on_error=True to refund it when an Exception escapes the block
+        before record() is called; only do so if failures mean the call never went out.
+        """
+        self.wait_if_needed(tokens)
+        return Reservation(self, tokens, refund_on_error)
 
-            # Try to break at paragraph boundary
-            slice_ = remaining[:max_chars]
-            break_pos = slice_.rfind("\n\n")
+    def commit(self, reservation: "Reservation", actual_prompt: int, actual_completion: int = 0) -> None:
+        """
+        Settle a reservation against actual usage.
 
-            # Fall back to sentence boundary
-            if break_pos < max_chars // 4:
-                match = None
-                for m in re.finditer(r"[.!?]\s+", slice_):
-                    match = m
-                break_pos = match.end() if match and match.end() > max_chars // 4 else -1
+        Tokens reserved beyond the actual usage are refunded to the bucket;
+        usage beyond the reservation is charged to it.
 
-            # Fall back to word boundary
-            if break_pos < max_chars // 4:
-                break_pos = slice_.rfind(" ")
+        Raises:
+            ValueError: If the reservation belongs to another throttle or was already settled.
+        """
+        if reservation.throttle is not self:
+            raise ValueError("Reservation was made on a different throttle.")
+        unused = reservation.tokens - (actual_prompt + actual_completion)
+        with self._lock:
+            if reservation.settled:
+                raise ValueError("Reservation has already been committed or refunded.")
+            reservation.settled = True
+
+            self._refill()
+            self._credit = min(self._capacity, self._credit + unused * _NS_PER_MINUTE)
+
+    def refund(self, reservation: "Reservation") -> None:
+        """Return all of a reservation's tokens, e.g. when the API call never went out."""
+        self.commit(reservation, 0)
+
+    # ── Chunking ────────────────────────────────────────────────
 
-            # Last resort: hard cut
-            if break_pos < max_chars // 4:
-                break_pos = max_chars
+    def _split_text(self, text: str, max_chars: int) -> Iterator[str]:
+        """Lazily split text into chunks of roughly max_chars, breaking on paragraph/sentence/word boundaries."""
+        if len(text) <= max_chars:
+            yield text
+            return
+
+        length = len(text)
+        pos = 0
 
-            chunks.append(remaining[:break_pos].rstrip())
-            remaining = remaining[break_pos:].lstrip()
+        while pos < length:
+            if length - pos <= max_chars:
+                yield text[pos:]
+                break
 
-        return chunks
+            start = pos
+            chunk_end, pos = _find_break(text, pos, max_chars)
+            yield text[start:chunk_end]
 
     # ── Main interface ──────────────────────────────────────────
 
@@ -173,33 +338,51 @@ class TokenThrottle:
 
         Each chunk is guaranteed to be under `chunk_size` tokens.
         Automatically sleeps between chunks when the budget is exhausted.
+        Chunks are split lazily, so only the current chunk is held alongside `text`.
         """
-        max_chars = int(self.chunk_size * self.chars_per_token)
-        chunks = self._split_text(text, max_chars)
-
-        for chunk in chunks:
+        for chunk in self._split_text(text, self._max_chars):
             tokens = self.estimate(chunk)
             self.wait_if_needed(tokens)
             yield chunk
 
+    def consume_many(self, texts: Iterable[str]) -> Iterator[str]:
+        """
+        Yield throttled chunks from each of `texts` in turn, sharing one budget.
+
+        Equivalent to chaining consume() over every text, but binds the bookkeeping
+        methods to locals once, which pays off when chunking many short texts.
+        """
+        estimate = self.estimate
+        wait_if_needed = self.wait_if_needed
+        split_text = self._split_text
+        max_chars = self._max_chars
+
+        for text in texts:
+            for chunk in split_text(text, max_chars):
+                wait_if_needed(estimate(chunk))
+                yield chunk
+
     # ── Utilities ───────────────────────────────────────────────
 
     @property
     def remaining_tokens(self) -> int:
-        """Tokens remaining in the current window."""
-        self._maybe_reset_window()
-        return max(0, self.budget - self._tokens_used)
+        """Tokens currently available in the bucket."""
+        with self._lock:
+            self._refill()
+            return max(0, self._credit // _NS_PER_MINUTE)
 
     @property
     def seconds_until_reset(self) -> float:
-        """Seconds until the current window resets."""
-        elapsed = time.monotonic() - self._window_start
-        return max(0.0, 60.0 - elapsed)
+        """Seconds until the bucket has refilled to the full budget."""
+        with self._lock:
+            self._refill()
+            return (self._capacity - self._credit) / self.budget / 1e9
 
     def __repr__(self) -> str:
+        remaining = self.remaining_tokens
         return (
             f"TokenThrottle(tpm={self.tpm}, budget={self.budget}, "
-            f"used={self._tokens_used}, remaining={self.remaining_tokens}, "
+            f"used={self.budget - remaining}, remaining={remaining}, "
             f"strict={self.strict})"
         )
 
@@ -208,13 +391,58 @@ class TokenThrottle:
 
 class BudgetExceeded(Exception):
     """
-    Raised in strict mode when a single request exceeds the per-window budget.
+    Raised in strict mode when a single request exceeds the per-minute budget.
 
     Catch this to handle oversized requests explicitly rather than silently waiting.
     """
     pass
 
 
+# ── Reservations ───────────────────────────────────────────────
+
+class Reservation:
+    """
+    Tokens reserved via TokenThrottle.reserve(), pending reconciliation.
+
+    Usage:
+        with throttle.reserve(throttle.estimate(prompt)) as r:
+            response = call_your_api(prompt)
+            r.record(response.usage.input_tokens, response.usage.output_tokens)
+
+    A reservation that is never recorded keeps its full estimate, including when
+    the block raises. Call refund() explicitly if the request never went out, or
+    reserve with refund_on_error=True to refund automatically on an Exception.
+    """
+
+    __slots__ = ("throttle", "tokens", "settled", "refund_on_error")
+
+    def __init__(self, throttle: TokenThrottle, tokens: int, refund_on_error: bool = False):
+        self.throttle = throttle
+        self.tokens = tokens
+        self.settled = False
+        self.refund_on_error = refund_on_error
+
+    def record(self, actual_prompt: int, actual_completion: int = 0) -> None:
+        """Report actual usage; shorthand for throttle.commit(self, ...)."""
+        self.throttle.commit(self, actual_prompt, actual_completion)
+
+    def __enter__(self) -> "Reservation":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # Opt-in only: the caller asserted failures mean the request never went out
+        if (
+            self.refund_on_error
+            and exc_type is not None
+            and issubclass(exc_type, Exception)
+            and not self.settled
+        ):
+            self.throttle.refund(self)
+
+    def __repr__(self) -> str:
+        return f"Reservation(tokens={self.tokens}, settled={self.settled})"
+
+
 # ── Sub-agent convenience ───────────────────────────────────────
 
 class SubAgentThrottle(TokenThrottle):
@@ -231,28 +459,39 @@ class SubAgentThrottle(TokenThrottle):
         throttle = SubAgentThrottle(budget_fraction=0.4)  # 12K TPM ceiling
     """
 
+    __slots__ = ()
+
     def __init__(
         self,
         total_tpm: int = 30_000,
         budget_fraction: float = 0.5,
+        margin: float = 0.85,
         **kwargs,
     ):
         """
         Args:
             total_tpm: The full API key TPM limit (shared across all agents).
             budget_fraction: Fraction of total_tpm this sub-agent may use (default 0.5 → 15K).
+            margin: Safety factor applied to total_tpm, as in TokenThrottle. The effective
+                    budget is min(total_tpm * budget_fraction, total_tpm * margin).
             **kwargs: Passed through to TokenThrottle (e.g. strict=True, chunk_size=...).
+                      A `budget` here further caps the ceiling:
+                      min(budget, total_tpm * budget_fraction, total_tpm * margin).
         """
+        fraction_budget = int(total_tpm * budget_fraction)
+        budget = kwargs.pop("budget", None)
         super().__init__(
             tokens_per_minute=total_tpm,
-            margin=budget_fraction,
+            margin=margin,
+            budget=min(budget, fraction_budget) if budget is not None else fraction_budget,
             **kwargs,
         )
 
     def __repr__(self) -> str:
+        remaining = self.remaining_tokens
         return (
             f"SubAgentThrottle(tpm={self.tpm}, budget={self.budget}, "
-            f"used={self._tokens_used}, remaining={self.remaining_tokens}, "
+            f"used={self.budget - remaining}, remaining={remaining}, "
             f"strict={self.strict})"
         )
 
@@ -261,9 +500,13 @@ class SubAgentThrottle(TokenThrottle):
 
 def estimate_file_tokens(path: str, chars_per_token: float = 4.0) -> int:
     """Estimate tokens in a file without reading it fully (uses file size)."""
-    import os
-    size = os.path.getsize(path)
-    return max(1, int(size / chars_per_token))
+    return max(1, int(os.stat(path).st_size / chars_per_token))
+
+
+def estimate_files_tokens(paths: Iterable[str], chars_per_token: float = 4.0) -> list[int]:
+    """Estimate tokens for many files from their sizes, in the same order as `paths`."""
+    stat = os.stat
+    return [max(1, int(stat(path).st_size / chars_per_token)) for path in paths]
 
 
 def estimate_url_tokens(url: str, chars_per_token: float = 4.0, timeout: int = 10) -> Optional[int]:
@@ -278,3 +521,30 @@ def estimate_url_tokens(url: str, chars_per_token: float = 4.0, timeout: int = 1
     except Exception:
         pass
     return None
+
+
+async def estimate_urls_tokens(
+    urls: list[str],
+    chars_per_token: float = 4.0,
+    timeout: int = 10,
+    concurrency: int = 64,
+) -> list[Optional[int]]:
+    """
+    Estimate tokens for many URLs concurrently via HEAD requests.
+
+    Runs up to `concurrency` estimate_url_tokens calls at once on worker threads,
+    so a batch costs about len(urls) / concurrency round trips instead of one per URL.
+    Results are returned in the same order as `urls`; entries are None if unavailable.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not urls:
+        return []
+
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(urls))) as pool:
+        return list(await asyncio.gather(*(
+            loop.run_in_executor(pool, estimate_url_tokens, url, chars_per_token, timeout)
+            for url in urls
+        )))